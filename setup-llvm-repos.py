@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 """Script to create LLVM trunk devel subvolume or snapshot.
 
 Creates BTRFS subvolume with trunk git-on-svn client, plus binutils, then
@@ -17,11 +17,19 @@ Todos:
 
 """
 
+import collections
+import concurrent.futures
 import getopt
 import multiprocessing
+import multiprocessing.pool
 import os
+import pwd
 import re
+import shlex
+import shutil
+import subprocess
 import sys
+import tempfile
 
 import script_utils as u
 
@@ -77,9 +85,26 @@ flag_include_libcxx = False
 # Run cmake cmds in parallel
 flag_parallel = True
 
+# Job count for make/ninja (set in parse_args from the CPU count)
+flag_jobs = None
+
+# Use shallow (--depth 1) git clones where the SCM flavor permits
+flag_shallow = True
+
+# Wrap compilers in ccache (when installed): rebuilds after small
+# changes become mostly cache hits instead of recompiles
+flag_ccache = True
+
+# Directory holding persistent bare mirrors of the cloned repos
+# (set in parse_args; default is $ssdroot/.mirrors)
+flag_mirror_root = None
+
 # Place from which to copy binutils
 flag_binutils_location = None
 
+# Existing populated subvolume to snapshot instead of cloning anew
+flag_clone_from = None
+
 # SSD root or root dir
 ssdroot = None
 
@@ -96,14 +121,78 @@ clang_git = "http://llvm.org/git/clang.git"
 clang_tools_git = "http://llvm.org/git/clang-tools-extra.git"
 llgo_git = "http://llvm.org/git/llgo.git"
 polly_git = "http://llvm.org/git/polly.git"
-polly_svn = "http://llvm.org/svn/llvm-project/polly"
-libcxx_svn = "https://llvm.org/svn/llvm-project/libcxx"
 libcxx_git = "http://llvm.org/git/libcxx.git"
-libcxxabi_svn = "https://llvm.org/svn/llvm-project/libcxxabi"
 libcxxabi_git = "http://llvm.org/git/libcxxabi.git"
-compiler_rt_svn = "https://llvm.org/svn/llvm-project/compiler-rt"
 compiler_rt_git = "http://llvm.org/git/compiler-rt.git"
 
+# Repos making up an LLVM devel subvolume. Fields: clone wave (a repo
+# must land in a later wave than the repo whose working tree contains
+# it), dest dir, git URL, parent dir relative to the subvolume top,
+# svn project path (None for repos with no svn side, which are always
+# cloned with git), and the include gate resolved against the
+# corresponding flag in do_subvol_create (None: always included).
+# Shallow/mirror/reference clone options and parallel dispatch all
+# apply uniformly to whatever this table lists.
+repos = [
+    (1, "llvm", llvm_git, "", "llvm/trunk", None),
+    # NB: full-history binutils clone can be incredibly slow
+    # sometimes, hence the shallow clone default.
+    (1, "binutils", binutils_git, "", None, "binutils"),
+    (2, "clang", clang_git, "llvm/tools", "cfe/trunk", None),
+    (2, "compiler-rt", compiler_rt_git, "llvm/projects",
+     "compiler-rt/trunk", None),
+    (2, "llgo", llgo_git, "llvm/tools", "llgo/trunk", "llgo"),
+    (2, "polly", polly_git, "llvm/tools", "polly/trunk", "polly"),
+    (2, "libcxx", libcxx_git, "llvm/projects", "libcxx/trunk", "libcxx"),
+    (2, "libcxxabi", libcxxabi_git, "llvm/projects",
+     "libcxxabi/trunk", "libcxx"),
+    (3, "extra", clang_tools_git, "llvm/tools/clang/tools",
+     "clang-tools-extra/trunk", "tools"),
+]
+
+# Templates for the helper scripts emitted into each build dir by
+# emit_rebuild_scripts ({bpath} is the build dir path, {flav} the
+# build flavor). Emitting each script with a single write() keeps the
+# syscall count down vs a dozen line-at-a-time writes per script.
+CLEAN_TMPL = """#!/bin/sh
+set -e
+cd {bpath} || exit 9
+cd ../binutils-build
+echo ... cleaning binutils-build
+make clean 1> ../build.{flav}/.clean.err 2>&1
+echo ... cleaning llvm
+cd ../build.{flav}
+ninja clean 1>> .clean.err 2>&1
+exit 0
+"""
+
+# -j is computed from nproc at run time so the scripts adapt to
+# whatever host they execute on; the ninja -l load cap keeps the
+# machine responsive, and NINJA_STATUS gives progress with ETA.
+BUILD_TMPL = """#!/bin/sh
+set -e
+cd {bpath} || exit 9
+cd ../binutils-build
+echo ... running make in binutils-build
+J=$(nproc)
+export NINJA_STATUS='[%f/%t %es] '
+{ccache_env}
+make -j"$J" 1> ../build.{flav}/.binutils-build.err 2>&1
+make -j"$J" all-gold 1> ../build.{flav}/.binutils-build.err 2>&1
+cd ../build.{flav}
+echo ... running ninja build
+ninja -j"$J" -l "$J"
+exit 0
+"""
+
+CLEAN_AND_BUILD_TMPL = """#!/bin/sh
+set -e
+cd {bpath} || exit 9
+sh ./.clean.sh
+sh ./.build-all.sh
+exit 0
+"""
+
 # Clang compilers. Must be full path.
 clang_c_compiler = "/usr/bin/clang-3.9"
 clang_cxx_compiler = "/usr/bin/clang++-3.9"
@@ -116,6 +205,11 @@ gcc_cxx_compiler = "/usr/bin/g++-4.8"
 covopt = "--coverage"
 cov_cmake_ccomp = ""
 
+# Compiled once at module scope; bootstrap_tooldir runs per flavor
+# (and again in each pool worker), so no point re-compiling per call
+bootstraprx = re.compile(r"^bootstrap\.(\S+)$")
+replaceuserrx = re.compile("REPLACE_WITH_USER")
+
 # Table with info on various cmake flavors. Key is build flavor,
 # value is a direct with various settings. Keys in this dict include:
 #
@@ -167,6 +261,19 @@ cmake_flavors = {
 }
 
 
+def default_job_count():
+  """Return the usable CPU count, for sizing pools and make/ninja -j.
+
+  Prefers os.sched_getaffinity, which respects cpusets/taskset (a CI
+  container may see far fewer CPUs than the machine has), falling
+  back to the raw CPU count elsewhere.
+  """
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return multiprocessing.cpu_count()
+
+
 def docmd(cmd):
   """Execute a command."""
   if flag_echo:
@@ -185,31 +292,242 @@ def doscmd(cmd):
   u.doscmd(cmd)
 
 
-def dochdir(thedir):
-  """Switch to dir."""
-  if flag_echo or flag_dryrun:
-    sys.stderr.write("cd " + thedir + "\n")
+def docmdnf(cmd):
+  """Execute a command, returning exit status."""
+  if flag_echo:
+    sys.stderr.write("executing: " + cmd + "\n")
+  if flag_dryrun:
+    return 0
+  return u.docmdnf(cmd)
+
+
+def docmd_in(dirpath, cmd):
+  """Execute a command with cwd=dirpath, echoing output.
+
+  Equivalent to chdir + docmd + chdir back, but threads the
+  directory through to subprocess instead of mutating the process
+  -global cwd (which would serialize everything and race against
+  pool workers).
+  """
+  if flag_echo:
+    sys.stderr.write("executing (in %s): %s\n" % (dirpath, cmd))
   if flag_dryrun:
     return
+  rc = subprocess.call(shlex.split(cmd), cwd=dirpath)
+  if rc != 0:
+    u.error("command failed (rc=%d): %s" % (rc, cmd))
+
+
+def doscmd_in(dirpath, cmd):
+  """Execute a command with cwd=dirpath, suppressing output.
+
+  Fatal-error counterpart of run_in_dir (chdir + doscmd
+  equivalent).
+  """
+  if run_in_dir(cmd, dirpath) != 0:
+    u.error("command failed: %s" % cmd)
+
+
+def cached_btrfs_ssdroot(here):
+  """Determine btrfs ssd root for dir, memoized across runs.
+
+  The underlying probe shells out to stat -f; its answer for a given
+  directory essentially never changes, so remember it in a dotfile
+  keyed by directory and skip the subprocess on later invocations.
+  """
+  cachefile = os.path.expanduser("~/.cache/setup-llvm-repos/ssdroot")
   try:
-    os.chdir(thedir)
+    with open(cachefile, "r") as rf:
+      for line in rf:
+        chunks = line.split()
+        if len(chunks) == 2 and chunks[0] == here:
+          u.verbose(2, "ssdroot cache hit: %s -> %s" % (here, chunks[1]))
+          return chunks[1]
+  except IOError:
+    pass
+  root = u.determine_btrfs_ssdroot(here)
+  try:
+    os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+    with open(cachefile, "a") as wf:
+      wf.write("%s %s\n" % (here, root))
+  except (IOError, OSError):
+    # cache is best-effort only
+    pass
+  return root
+
+
+def do_mkdir(dirpath):
+  """Create dirpath if needed (pure python; no subprocess).
+
+  Returns 0 on success, nonzero otherwise.
+  """
+  if flag_echo:
+    sys.stderr.write("executing: mkdir -p %s\n" % dirpath)
+  if flag_dryrun:
+    return 0
+  try:
+    os.makedirs(dirpath, exist_ok=True)
   except OSError as err:
-    u.error("chdir failed: %s" % err)
+    u.warning("mkdir failed: %s" % err)
+    return 1
+  return 0
+
+
+def git_clone_opts(uses_svn=True):
+  """Return extra options to pass to 'git clone' invocations.
+
+  Shallow clones (--depth 1) cut bytes transferred and wall time by
+  an order of magnitude for big repos such as llvm and binutils; for
+  a trunk devel volume we only need the tip anyhow. Not usable with
+  git-svn, which requires full history (-H disables shallow clones
+  for the other flavors as well; if history is needed but old blobs
+  are not, a --filter=blob:none partial clone is the middle ground).
+  Repos that are never git-svn'd (ex: binutils) pass uses_svn=False
+  to get shallow clones even in the default git-svn setup.
+  """
+  if not flag_shallow:
+    return ""
+  if uses_svn and flag_scm_flavor == "git-svn":
+    return ""
+  return "--depth 1 --no-tags --single-branch "
+
+
+def ensure_mirror(url):
+  """Create or refresh the persistent bare mirror for a repo URL.
+
+  Mirrors live under $ssdroot/.mirrors (override with -m) and are
+  shared by all subvolumes on the disk, so creating an Nth subvolume
+  reuses pack data already on the SSD (via git alternates) instead of
+  re-downloading hundreds of MB from llvm.org / sourceware.org.
+  Returns the mirror path, or None if the mirror can't be set up
+  (clone sites use --reference-if-able, which tolerates that).
+  """
+  if not flag_mirror_root:
+    return None
+  mdir = "%s/%s" % (flag_mirror_root, os.path.basename(url))
+  if os.path.exists(mdir):
+    if docmdnf("git --git-dir=%s remote update --prune" % mdir) != 0:
+      u.warning("unable to refresh mirror %s" % mdir)
+    return mdir
+  do_mkdir(flag_mirror_root)
+  if docmdnf("git clone --mirror --bare %s %s" % (url, mdir)) != 0:
+    u.warning("unable to create mirror of %s in %s" % (url, mdir))
+    return None
+  return mdir
+
+
+def git_clone_cmd(url, dest="", uses_svn=True):
+  """Compose 'git clone' command for url, honoring shallow/mirror flags."""
+  refarg = ""
+  mirror = ensure_mirror(url)
+  if mirror:
+    refarg = "--reference-if-able %s " % mirror
+  cmd = "git clone %s%s%s" % (git_clone_opts(uses_svn), refarg, url)
+  if dest:
+    cmd = "%s %s" % (cmd, dest)
+  return cmd
+
+
+def run_in_dir(cmd, dirpath):
+  """Run a command with cwd=dirpath, suppressing output unless error.
+
+  Pool-worker-safe equivalent of chdir + doscmd: it leaves the
+  process-global cwd alone (workers racing on os.chdir would corrupt
+  each other) and reports failure via return code rather than exiting
+  (u.error in a worker would wedge the pool join).
+  """
+  if flag_echo:
+    sys.stderr.write("executing (in %s): %s\n" % (dirpath, cmd))
+  if flag_dryrun:
+    return 0
+  args = shlex.split(cmd)
+  cmdtf = tempfile.NamedTemporaryFile(mode="w", delete=True)
+  rc = subprocess.call(args, cwd=dirpath, stdout=cmdtf, stderr=cmdtf)
+  if rc != 0:
+    u.warning("command failed (rc=%d) cmd: %s" % (rc, cmd))
+    u.warning("output from failing command:")
+    subprocess.call(["cat", cmdtf.name])
+  cmdtf.close()
+  return rc
+
+
+def run_shell_in(script, dirpath):
+  """Run an '&&'-chained shell command line with cwd=dirpath.
+
+  Batching a sequence of small, no-output commands into a single
+  shell invocation amortizes the per-step fork+exec round trip.
+  Output is suppressed unless a step fails; returns the shell's exit
+  status.
+  """
+  if flag_echo:
+    sys.stderr.write("executing (in %s): %s\n" % (dirpath, script))
+  if flag_dryrun:
+    return 0
+  cmdtf = tempfile.NamedTemporaryFile(mode="w", delete=True)
+  rc = subprocess.call(script, shell=True, cwd=dirpath,
+                       stdout=cmdtf, stderr=cmdtf)
+  if rc != 0:
+    u.warning("command failed (rc=%d) cmd: %s" % (rc, script))
+    u.warning("output from failing command:")
+    subprocess.call(["cat", cmdtf.name])
+  cmdtf.close()
+  return rc
+
+
+def clone_worker(parentdir, url, dest, svnpath):
+  """Clone a single repo into parentdir (pool worker; never chdirs).
+
+  svnpath, if set, is the project path (ex: "cfe/trunk") used both
+  for plain svn checkouts and for git svn init in git-svn mode; repos
+  with no svn counterpart (binutils) pass None and always use git.
+  Returns 0 on success, nonzero otherwise.
+  """
+  if flag_scm_flavor == "svn" and svnpath:
+    svnroot = llvm_rw_svn if dest == "llvm" else llvm_ro_svn
+    return run_in_dir("svn co %s/%s %s" % (svnroot, svnpath, dest),
+                      parentdir)
+  uses_svn = bool(svnpath)
+  if run_in_dir(git_clone_cmd(url, dest, uses_svn), parentdir) != 0:
+    return 1
+  if svnpath and flag_scm_flavor == "git-svn":
+    repodir = os.path.join(parentdir, dest)
+    return run_shell_in("git svn init %s/%s --username=%s && "
+                        "git config svn-remote.svn.fetch "
+                        ":refs/remotes/origin/master && "
+                        "git svn rebase -l" % (llvm_git_on_svn,
+                                               svnpath, flag_user),
+                        repodir)
+  return 0
+
 
+def dispatch_jobs(worker, jobs, use_threads=False, what="command"):
+  """Run worker over a batch of independent jobs, in parallel if enabled.
 
-def do_llvmtool_create(top, tool, pdir, gitloc, svnloc):
-  """Create new sub-repo within llvm/tools or llvm/projects."""
-  dochdir("%s/llvm/%s" % (top, pdir))
-  if flag_scm_flavor == "git":
-    doscmd("svn co %s/%s/trunk %s" % (llvm_ro_svn, tool))
+  Each job is a tuple of positional args for worker; workers return 0
+  on success and must never chdir (see run_in_dir). use_threads picks
+  a thread pool over a process pool, which is the right choice for
+  I/O-bound jobs such as fetches. Fails loudly if any job fails.
+  """
+  if not jobs:
+    return
+  if flag_parallel and not flag_dryrun and len(jobs) > 1:
+    if use_threads:
+      pool = multiprocessing.pool.ThreadPool(processes=min(len(jobs), 8))
+    else:
+      pool = multiprocessing.Pool(processes=len(jobs))
+    results = [pool.apply_async(worker, list(job)) for job in jobs]
+    pool.close()
+    rc = 0
+    for r in results:
+      if r.get(timeout=1800) != 0:
+        rc = 1
+    pool.join()
+    if rc:
+      u.error("one or more %s jobs failed" % what)
   else:
-    doscmd("git clone %s %s" % (gitloc, tool))
-    if flag_scm_flavor == "git-svn":
-      dochdir("%s" % tool)
-      doscmd("git svn init %s/trunk "
-             "--username=%s" % (svnloc, flag_user))
-      doscmd("git config svn-remote.svn.fetch :refs/remotes/origin/master")
-      doscmd("git svn rebase -l")
+    for job in jobs:
+      if worker(*job) != 0:
+        u.error("%s job failed: %s" % (what, " ".join(str(a) for a in job)))
 
 
 def do_subvol_create():
@@ -218,117 +536,108 @@ def do_subvol_create():
   if os.path.exists(sv):
     u.verbose(1, "subvolume %s already exists, skipping creation" % sv)
     return
-  here = os.getcwd()
   if flag_btrfs:
     docmd("snapshotutil.py mkvol %s" % flag_subvol)
-  else:
-    docmd("mkdir %s" % flag_subvol)
-  dochdir(ssdroot)
-  dochdir(flag_subvol)
-  top = "%s/%s" % (ssdroot, flag_subvol)
+  elif do_mkdir(sv) != 0:
+    u.error("unable to create %s" % sv)
+  top = sv
+
+  # Build the clone waves from the repos table. The clones are
+  # network-bound with high per-remote latency, so overlapping the
+  # jobs in each wave wins back most of the sum-of-latencies wall
+  # time of the old serial sequence.
+  include = {None: True,
+             "tools": flag_include_tools,
+             "llgo": flag_include_llgo,
+             "polly": flag_include_polly,
+             "libcxx": flag_include_libcxx,
+             "binutils": not flag_binutils_location}
+  waves = {}
+  for wave, dest, url, parentrel, svnpath, gate in repos:
+    if not include[gate]:
+      continue
+    parent = "%s/%s" % (top, parentrel) if parentrel else top
+    waves.setdefault(wave, []).append((parent, url, dest, svnpath))
+  for wave in sorted(waves):
+    dispatch_jobs(clone_worker, waves[wave], what="clone")
 
-  # First llvm
-  if flag_scm_flavor == "svn":
-    doscmd("svn co %s/llvm/trunk llvm" % llvm_rw_svn)
-  else:
-    doscmd("git clone %s" % llvm_git)
-    if flag_scm_flavor == "git-svn":
-      dochdir("llvm")
-      doscmd("git svn init %s/llvm/trunk "
-             "--username=%s" % (llvm_git_on_svn, flag_user))
-      doscmd("git config svn-remote.svn.fetch :refs/remotes/origin/master")
-      doscmd("git svn rebase -l")
-
-  # Next clang
-  dochdir("%s/llvm/tools" % top)
-  if flag_scm_flavor == "svn":
-    doscmd("svn co %s/cfe/trunk clang" % llvm_ro_svn)
-  else:
-    doscmd("git clone %s" % clang_git)
-    if flag_scm_flavor == "git-svn":
-      dochdir("clang")
-      doscmd("git svn init %s/cfe/trunk "
-             "--username=%s" % (llvm_git_on_svn, flag_user))
-      doscmd("git config svn-remote.svn.fetch :refs/remotes/origin/master")
-      doscmd("git svn rebase -l")
-
-  # Now clang tools
-  if flag_include_tools:
-    dochdir("%s/llvm/tools/clang/tools" % top)
-    if flag_scm_flavor == "git":
-      doscmd("svn co %s/clang-tools-extra/trunk extra" % llvm_ro_svn)
-    else:
-      doscmd("git clone %s extra" % clang_tools_git)
-      if flag_scm_flavor == "git-svn":
-        dochdir("extra")
-        doscmd("git svn init %s/clang-tools-extra/trunk "
-               "--username=%s" % (llvm_git_on_svn, flag_user))
-        doscmd("git config svn-remote.svn.fetch :refs/remotes/origin/master")
-        doscmd("git svn rebase -l")
-
-  # Now llgo
-  if flag_include_llgo:
-    do_llvmtool_create(top, "llgo", "tools", llgo_git, llgo_svn)
-
-  # Now polly
-  if flag_include_polly:
-    do_llvmtool_create(top, "polly", "tools", polly_git, polly_svn)
-
-  # Now libcxx
-  if flag_include_libcxx:
-    do_llvmtool_create(top, "libcxx", "projects", libcxx_git, libcxx_svn)
-    do_llvmtool_create(top, "libcxxabi", "projects", libcxxabi_git, libcxxabi_svn)
-
-  # Now compiler-rt
-  do_llvmtool_create(top, "compiler-rt", "projects", compiler_rt_git, compiler_rt_svn)
-
-  # Now binutils. NB: git clone can be incredibly slow sometimes.
-  # Consider adding --depth 1 maybe?
-  dochdir(top)
   if flag_binutils_location:
-    doscmd("cp -r %s binutils" % flag_binutils_location)
-  else:
-    doscmd("git clone %s binutils" % binutils_git)
-  dochdir(here)
+    if run_in_dir("cp -r %s binutils" % flag_binutils_location, top) != 0:
+      u.error("unable to copy binutils from %s" % flag_binutils_location)
 
 
-def do_fetch(flavor, where):
-  """Update with svn or git."""
-  here = os.getcwd()
-  dochdir(where)
-  if flavor == "git":
-    docmd("git fetch")
-  elif flavor == "git-svn":
-    docmd("git fetch")
-    docmd("git svn rebase -l")
-  else:
-    docmd("svn update")
-  dochdir(here)
+# Cached results of the per-volume repo scan (see find_repo_dirs)
+fetch_dirs_cache = {}
 
 
-def fetch_in_volume():
-  """Update subvolume with svn or git."""
-  top = "%s/%s" % (ssdroot, flag_subvol)
-  dochdir(top)
-  # First binutils (which is only git)
-  do_fetch("git", "binutils")
-  dochdir("llvm")
-  # Next llvm stuff
+def has_svn_remote(repodir):
+  """Return True if the git repo in repodir has a git-svn remote."""
+  if flag_dryrun:
+    return True
+  with open(os.devnull, "w") as devnull:
+    rc = subprocess.call(shlex.split("git config --get svn-remote.svn.url"),
+                         cwd=repodir, stdout=devnull, stderr=devnull)
+  return rc == 0
+
+
+def fetch_worker(flavor, repodir):
+  """Update a single repo (pool worker; never chdirs).
+
+  Returns 0 on success, nonzero otherwise.
+  """
+  if flavor == "svn":
+    return run_in_dir("svn update", repodir)
+  if flavor == "git-svn" and has_svn_remote(repodir):
+    # A single 'git svn fetch' talks straight to the svn remote --
+    # one round trip instead of a git refs advertisement followed by
+    # a rebase against stale svn refs. The rebase -l that follows is
+    # purely local.
+    if run_in_dir("git svn fetch", repodir) != 0:
+      return 1
+    return run_in_dir("git svn rebase -l", repodir)
+  return run_in_dir("git fetch --no-tags --prune", repodir)
+
+
+def find_repo_dirs(top):
+  """Return dirs of repos below top/llvm (cached across calls).
+
+  Walks the tree in-process instead of shelling out to find and
+  parsing its stdout through a pipe. Pruning at each .git/.svn
+  boundary also skips the SCM metadata trees themselves (an llvm
+  .git holds thousands of object dirs that find would visit).
+  """
   tofind = ".git"
   if flag_scm_flavor == "svn":
     tofind = ".svn"
-  lines = u.docmdlines("find . -depth -name %s -print" % tofind)
-  for line in lines:
-    do_fetch(flag_scm_flavor, line.strip())
-  dochdir(top)
+  key = (top, tofind)
+  if key in fetch_dirs_cache:
+    return fetch_dirs_cache[key]
+  dirs = []
+  for root, subdirs, _ in os.walk("%s/llvm" % top):
+    if tofind in subdirs:
+      dirs.append(root)
+    subdirs[:] = [d for d in subdirs if d != tofind]
+  fetch_dirs_cache[key] = dirs
+  return dirs
+
+
+def fetch_in_volume():
+  """Update subvolume with svn or git."""
+  top = "%s/%s" % (ssdroot, flag_subvol)
+  # First binutils (which is only git), then the llvm tree. The
+  # fetches are all independent, so batch them up and let
+  # dispatch_jobs overlap the network stalls.
+  jobs = [("git", "%s/binutils" % top)]
+  for repodir in find_repo_dirs(top):
+    jobs.append((flag_scm_flavor, repodir))
+  dispatch_jobs(fetch_worker, jobs, use_threads=True, what="fetch")
 
 
 def bootstrap_tooldir(flav):
   """Return tool directory for bootstrap build."""
   fd = cmake_flavors[flav]
   ccflav = fd["ccflav"]
-  rx = re.compile(r"^bootstrap\.(\S+)$")
-  m = rx.match(ccflav)
+  m = bootstraprx.match(ccflav)
   if not m:
     return None
   tb = m.group(1)
@@ -366,6 +675,23 @@ def select_dyld_library_path(flav):
   return "env DYLD_LIBRARY_PATH=%s/lib" % tbdir
 
 
+def ccache_enabled():
+  """Return True if builds should (and can) run compilers via ccache."""
+  return flag_ccache and shutil.which("ccache") is not None
+
+
+def ccache_env_setting():
+  """Shell fragment pointing ccache at a cache shared across subvolumes.
+
+  A single cache under the ssd root means a rebuild in a fresh
+  snapshot/subvolume hits objects compiled in any earlier one, instead
+  of each tree warming its own cache from scratch.
+  """
+  if not ccache_enabled():
+    return ""
+  return "CCACHE_DIR=%s/.ccache" % ssdroot
+
+
 def select_compiler_flavor(flav):
   """Returns string with cmake compiler setup."""
   extrastuff = ""
@@ -382,6 +708,10 @@ def select_compiler_flavor(flav):
   elif ccflav == "clang":
     build_c_compiler = clang_c_compiler
     build_cxx_compiler = clang_cxx_compiler
+    # lld parallelizes the link step, typically the serial bottleneck
+    # of an llvm build; only usable when clang drives the link
+    if shutil.which("ld.lld"):
+      extrastuff = "-DLLVM_USE_LINKER=lld "
   elif ccflav == "def":
     return ""
   elif tbdir:
@@ -389,8 +719,16 @@ def select_compiler_flavor(flav):
     build_cxx_compiler = "%s/bin/clang++" % tbdir
     extrastuff = ("-DCMAKE_RANLIB=%s/bin/llvm-ranlib "
                   "-DCMAKE_AR=%s/bin/llvm-ar " % (tbdir, tbdir))
+    # prefer the freshly built lld from the bootstrap tool dir
+    if os.path.exists("%s/bin/ld.lld" % tbdir):
+      extrastuff += "-DLLVM_USE_LINKER=%s/bin/ld.lld " % tbdir
   else:
     u.error("internal error -- bad ccflav setting %s" % ccflav)
+  if ccache_enabled():
+    # COMPILER_LAUNCHER is cmake's supported wrapper hook; the
+    # compiler paths themselves stay untouched
+    extrastuff += ("-DCMAKE_C_COMPILER_LAUNCHER=ccache "
+                   "-DCMAKE_CXX_COMPILER_LAUNCHER=ccache ")
   return ("%s-DCMAKE_C_COMPILER=%s -DCMAKE_ASM_COMPILER=%s "
           "-DCMAKE_CXX_COMPILER=%s" % (extrastuff,
                                        build_c_compiler,
@@ -398,24 +736,48 @@ def select_compiler_flavor(flav):
                                        build_cxx_compiler))
 
 
-def emit_cmake_cmd_script(flav, targdir):
-  """Emit/archive cmake cmds for flav."""
+# Bundled result of the four per-flavor selectors (see
+# build_flavor_spec)
+FlavorSpec = collections.namedtuple("FlavorSpec",
+                                    ["dyld", "ccomp", "cmtype", "extra"])
+
+
+def build_flavor_spec(flav):
+  """Compute the per-flavor cmake selectors in a single pass.
+
+  Each select_* helper re-walks cmake_flavors; computing all four
+  once per flavor in the parent (and handing the resulting tuple
+  around) avoids repeating the dict lookups at every use site.
+  """
+  return FlavorSpec(dyld=select_dyld_library_path(flav),
+                    ccomp=select_compiler_flavor(flav),
+                    cmtype=select_cmake_type(flav),
+                    extra=select_cmake_extras(flav))
+
+
+def emit_cmake_cmd_script(flav, targdir, builddir, spec=None):
+  """Emit/archive cmake cmds for flav into builddir."""
   bpath = ("LLVM_BINUTILS_INCDIR=%s/%s"
            "/binutils/include" % (ssdroot, targdir))
-  u.verbose(0, "...kicking off cmake for %s in parallel..." % flav)
-  dyldsetting = select_dyld_library_path(flav)
-  ccomp = select_compiler_flavor(flav)
-  cmake_type = select_cmake_type(flav)
-  extra = select_cmake_extras(flav)
-  limitlink = "LLVM_PARALLEL_LINK_JOBS=8"
-  cmake_cmd = ("%s cmake -D%s -DCMAKE_BUILD_TYPE=%s -D%s %s %s -G Ninja "
-               "../llvm" % (dyldsetting, limitlink,
-                            cmake_type, bpath, ccomp, extra))
+  if spec is None:
+    spec = build_flavor_spec(flav)
+  # ninja happily oversubscribes the link step; with lld in play two
+  # concurrent links saturate the cores while bounding linker memory
+  limitjobs = 2 if "LLVM_USE_LINKER" in spec.ccomp else 8
+  limitlink = "LLVM_PARALLEL_LINK_JOBS=%d" % limitjobs
+  ccenv = ccache_env_setting()
+  # the command runs through shlex.split/subprocess with no shell, so
+  # a bare VAR=val prefix would be exec'ed as argv[0]; route it
+  # through env (which also chains with any env DYLD_... prefix)
+  cmake_cmd = ("%s%s cmake -D%s -DCMAKE_BUILD_TYPE=%s -D%s %s %s -G Ninja "
+               "../llvm" % ("env %s " % ccenv if ccenv else "",
+                            spec.dyld, limitlink,
+                            spec.cmtype, bpath, spec.ccomp, spec.extra))
   if flag_dryrun:
-    print "+++ archiving cmake cmd: %s" % cmake_cmd
+    print("+++ archiving cmake cmd: %s" % cmake_cmd)
   else:
     try:
-      with open("./.cmake_cmd", "w") as wf:
+      with open(os.path.join(builddir, ".cmake_cmd"), "w") as wf:
         wf.write(cmake_cmd)
         wf.write("\n")
     except IOError:
@@ -423,118 +785,143 @@ def emit_cmake_cmd_script(flav, targdir):
   return cmake_cmd
 
 
-def emit_rebuild_scripts(flav, targdir):
-  """Emit top-level clean, rebuild scripts."""
-  bpath = "%s/%s/build.%s" % (ssdroot, targdir, flav)
+def emit_rebuild_scripts(flav, builddir):
+  """Emit top-level clean, rebuild scripts into builddir.
+
+  Writes use absolute paths, so emission doesn't depend on whatever
+  the process cwd happens to be and can run in any order relative to
+  (or inside) the pool workers.
+  """
   if flag_dryrun:
-    print "+++ archiving clean + build cmds"
+    print("+++ archiving clean + build cmds")
     return
-
-  # Emit clean script
+  ccenv = ccache_env_setting()
+  ccache_env = "export %s" % ccenv if ccenv else ""
   try:
-    with open("./.clean.sh", "w") as wf:
-      wf.write("#!/bin/sh\n")
-      wf.write("set -e\n")
-      wf.write("cd %s || exit 9\n" % bpath)
-      wf.write("cd ../binutils-build\n")
-      wf.write("echo ... cleaning binutils-build\n")
-      wf.write("make clean 1> ../build.%s/.clean.err 2>&1\n" % flav)
-      wf.write("echo ... cleaning llvm\n")
-      wf.write("cd ../build.%s\n" % flav)
-      wf.write("ninja clean 1>> .clean.err 2>&1\n")
-      wf.write("exit 0\n")
+    with open(os.path.join(builddir, ".clean.sh"), "w") as wf:
+      wf.write(CLEAN_TMPL.format(bpath=builddir, flav=flav))
+    with open(os.path.join(builddir, ".build-all.sh"), "w") as wf:
+      wf.write(BUILD_TMPL.format(bpath=builddir, flav=flav,
+                                 ccache_env=ccache_env))
+    with open(os.path.join(builddir, ".clean-and-build-all.sh"), "w") as wf:
+      wf.write(CLEAN_AND_BUILD_TMPL.format(bpath=builddir, flav=flav))
   except IOError:
-    u.error("open/write failed for .clean.sh")
+    u.error("open/write failed emitting rebuild scripts for %s" % flav)
 
-  # Emit build-all script
-  try:
-    with open("./.build-all.sh", "w") as wf:
-      wf.write("#!/bin/sh\n")
-      wf.write("set -e\n")
-      wf.write("cd %s || exit 9\n" % bpath)
-      wf.write("cd ../binutils-build\n")
-      wf.write("echo ... running make in binutils-build\n")
-      wf.write("NP=`nproc`\n")
-      wf.write("make -j${NP} 1> ../build.%s/.binutils-build.err 2>&1\n" % flav)
-      wf.write("make -j${NP} all-gold 1> "
-               "../build.%s/.binutils-build.err 2>&1\n" % flav)
-      wf.write("cd ../build.%s\n" % flav)
-      wf.write("echo ... running ninja build\n")
-      wf.write("ninja\n")
-      wf.write("exit 0\n")
-  except IOError:
-    u.error("open/write failed for .build-all.sh")
-
-  # Emit clean-and-build-all script
-  try:
-    with open("./.clean-and-build-all.sh", "w") as wf:
-      wf.write("#!/bin/sh\n")
-      wf.write("set -e\n")
-      wf.write("cd %s || exit 9\n" % bpath)
-      wf.write("sh ./.clean.sh\n")
-      wf.write("sh ./.build-all.sh\n")
-      wf.write("exit 0\n")
-  except IOError:
-    u.error("open/write failed for .cmake_cmd")
 
+def configure_binutils_worker(builddir):
+  """Create binutils bin dir and run configure (pool worker).
 
-def do_configure_binutils(targdir):
-  """Create binutils bin dir and run configure."""
-  dochdir(ssdroot)
-  dochdir(targdir)
-  docmd("mkdir binutils-build")
-  dochdir("binutils-build")
-  doscmd("../binutils/configure --enable-gold "
-         "--enable-plugins --disable-werror")
-  dochdir("..")
+  The autoconf pass is a long serial stretch with no build-time
+  dependency on the llvm cmake runs, so do_setup_cmake dispatches it
+  as one more pool task to overlap it with the cmake configures.
+  Returns 0 on success, nonzero otherwise.
+  """
+  if do_mkdir(builddir) != 0:
+    return 1
+  return run_in_dir("../binutils/configure --enable-gold "
+                    "--enable-plugins --disable-werror", builddir)
 
 
 def run_cmake(builddir, cmake_cmd):
-  """Cmake run helper."""
-  try:
-    os.chdir(builddir)
-  except OSError as err:
-    u.warning("chdir failed: %s" % err)
-    return 1
-  rv = u.doscmd(cmake_cmd, True)
-  if not rv:
-    u.warning("cmd command returned bad status: %s" % cmake_cmd)
-    return 1
-  return 0
+  """Cmake run helper (pool worker; never chdirs)."""
+  return run_in_dir(cmake_cmd, builddir)
+
+
+def build_cmake_jobs(targdir):
+  """Precompute (flav, builddir, cmake_cmd) for every build flavor.
+
+  All the flavor-table lookups, directory creation and helper-script
+  emission happen here, once, in the parent: by dispatch time a pool
+  worker receives only an opaque path and command string, so forked
+  children never consult cmake_flavors or any other module state.
+  """
+  jobs = []
+  for flav in cmake_flavors:
+    builddir = "%s/%s/build.%s" % (ssdroot, targdir, flav)
+    if do_mkdir(builddir) != 0:
+      u.error("unable to create %s" % builddir)
+    emit_rebuild_scripts(flav, builddir)
+    cmake_cmd = emit_cmake_cmd_script(flav, targdir, builddir,
+                                      build_flavor_spec(flav))
+    jobs.append((flav, builddir, cmake_cmd))
+  return jobs
 
 
 def do_setup_cmake(targdir):
   """Run cmake in each of the bin dirs."""
-  dochdir(ssdroot)
-  dochdir(targdir)
-  pool = None
-  if flag_parallel:
-    nworkers = len(cmake_flavors)
-    pool = multiprocessing.Pool(processes=nworkers)
-  results = []
-  for flav in cmake_flavors:
-    docmd("mkdir build.%s" % flav)
-    dochdir("build.%s" % flav)
-    emit_rebuild_scripts(flav, targdir)
-    cmake_cmd = emit_cmake_cmd_script(flav, targdir)
-    if flag_parallel and not flag_dryrun:
+  executor = None
+  futures = {}
+  jobs = build_cmake_jobs(targdir)
+  if flag_parallel and not flag_dryrun:
+    # One extra task for the binutils configure below, but never more
+    # workers than CPUs: each cmake forks its own (largely serial)
+    # compile tests, and on a small CI machine a worker per flavor
+    # oversubscribes. CMAKE_BUILD_PARALLEL_LEVEL, if set, caps it
+    # further.
+    nworkers = min(len(cmake_flavors) + 1, default_job_count())
+    env_level = os.getenv("CMAKE_BUILD_PARALLEL_LEVEL")
+    if env_level and env_level.isdigit() and int(env_level) > 0:
+      nworkers = min(nworkers, int(env_level))
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=nworkers)
+  # Kick off binutils configure first so the long autoconf pass
+  # overlaps with the cmake runs (no dependency in either direction).
+  binutils_builddir = "%s/%s/binutils-build" % (ssdroot, targdir)
+  if executor:
+    u.verbose(0, "...kicking off binutils configure in parallel...")
+    fut = executor.submit(configure_binutils_worker, binutils_builddir)
+    futures[fut] = "binutils configure"
+  elif configure_binutils_worker(binutils_builddir) != 0:
+    u.error("binutils configure failed")
+  for flav, builddir, cmake_cmd in jobs:
+    if executor:
       u.verbose(0, "...kicking off cmake for %s in parallel..." % flav)
-      builddir = "%s/%s/build.%s" % (ssdroot, targdir, flav)
-      r = pool.apply_async(run_cmake, [builddir, cmake_cmd])
-      results.append(r)
-    else:
-      doscmd(cmake_cmd)
-    dochdir("..")
-  nr = len(results)
+      futures[executor.submit(run_cmake, builddir, cmake_cmd)] = flav
+    elif run_cmake(builddir, cmake_cmd) != 0:
+      u.error("cmake failed in %s" % builddir)
+  if not futures:
+    return
+  # Collect results as they land rather than in submission order: a
+  # fast failure surfaces immediately instead of queueing behind a
+  # slow earlier task, and tasks not yet started get cancelled.
   rc = 0
-  for idx in range(0, nr):
-    r = results[idx]
-    u.verbose(1, "waiting on result %d" % idx)
-    res = r.get(timeout=600)
-    if res != 0:
-      rc = 1
+  # as_completed's timeout bounds the whole iteration, not each
+  # result; scale it by the task count so a small machine working
+  # through the tasks mostly serially keeps the old per-task budget.
+  try:
+    for fut in concurrent.futures.as_completed(futures,
+                                               timeout=600 * len(futures)):
+      what = futures[fut]
+      if fut.result() != 0:
+        u.warning("%s failed" % what)
+        executor.shutdown(wait=False, cancel_futures=True)
+        rc = 1
+        break
+      u.verbose(0, "...%s complete..." % what)
+  except concurrent.futures.TimeoutError:
+    executor.shutdown(wait=False, cancel_futures=True)
+    u.error("timed out waiting for cmake/configure cmds")
   if rc:
-    u.error("one or more cmake cmds failed")
+    u.error("one or more cmake/configure cmds failed")
+  executor.shutdown()
+
+
+def do_subvol_clone_existing(src, dst):
+  """Create subvolume dst as a btrfs snapshot of populated subvol src.
+
+  Snapshotting an existing subvolume is copy-on-write: near-zero time
+  and near-zero space regardless of tree size, versus GBs of I/O and
+  minutes of wall time for a from-scratch clone. A fetch afterwards
+  brings the snapshot up to date, moving only the delta since src was
+  last updated.
+  """
+  if not flag_dryrun and not os.path.exists("%s/%s" % (ssdroot, src)):
+    u.error("clone source subvolume %s/%s does not exist" % (ssdroot, src))
+  if os.path.exists("%s/%s" % (ssdroot, dst)):
+    u.verbose(1, "subvolume %s already exists, skipping creation" % dst)
+    return
+  docmd("snapshotutil.py mksnap %s %s" % (src, dst))
+  fetch_in_volume()
 
 
 def do_snapshot_create():
@@ -549,40 +936,40 @@ def do_configure():
   """Run configure/setup/cmake in snapshot or subvol."""
   if flag_do_fetch:
     fetch_in_volume()
-  dochdir(ssdroot)
   targdir = flag_subvol
   if flag_snapshot:
     targdir = flag_snapshot
-  do_configure_binutils(targdir)
+  # binutils configure happens inside do_setup_cmake, overlapped
+  # with the cmake runs
   do_setup_cmake(targdir)
 
 
 def do_build():
   """Perform build in snapshot or subvol."""
-  dochdir(ssdroot)
+  targ = flag_subvol
   if flag_snapshot:
-    dochdir(flag_snapshot)
-  else:
-    dochdir(flag_subvol)
+    targ = flag_snapshot
+  targdir = "%s/%s" % (ssdroot, targ)
   if flag_binutils_build:
-    dochdir("binutils-build")
-    nworkers = multiprocessing.cpu_count()
-    doscmd("make -j%d" % nworkers)
-    doscmd("make -j%d all-gold" % nworkers)
-    dochdir("..")
+    doscmd_in("%s/binutils-build" % targdir, "make -j%d" % flag_jobs)
+    doscmd_in("%s/binutils-build" % targdir, "make -j%d all-gold" % flag_jobs)
   else:
     u.verbose(0, "... binutils build stubbed out")
   if flag_run_ninja:
-    dochdir("build.opt")
-    docmd("ninja")
-    dochdir("..")
+    # explicit -j (ninja defaults to nproc+2, too eager once parallel
+    # linkers are in play) plus a load-average cap for responsiveness
+    docmd_in("%s/build.opt" % targdir, "ninja -j%d -l %d" % (flag_jobs,
+                                                             flag_jobs))
   else:
     u.verbose(0, "... ninja build stubbed out")
 
 
 def perform():
   """Main driver routine."""
-  do_subvol_create()
+  if flag_clone_from:
+    do_subvol_clone_existing(flag_clone_from, flag_subvol)
+  else:
+    do_subvol_create()
   if flag_snapshot:
     do_snapshot_create()
   if flag_configure:
@@ -595,7 +982,7 @@ def usage(msgarg):
   me = os.path.basename(sys.argv[0])
   if msgarg:
     sys.stderr.write("error: %s\n" % msgarg)
-  print """\
+  print("""\
     usage:  %s [options]
 
     options:
@@ -603,12 +990,17 @@ def usage(msgarg):
     -r R  root subvolume is R
     -s S  snapshot is S
     -c    run configure in subvol, not snapshot
+    -C V  create root subvolume as btrfs snapshot of existing
+          populated subvolume V (then fetch), instead of cloning
     -n    stub out ninja build
     -N    stub out binutils build
     -q    quiet mode (do not echo commands before executing)
     -S X  use SCM flavor X (either git, svn, or git-svn). Def: git-svn
     -B D  copy binutils from dir D instead of performing 'git clone'
     -D    dryrun mode (echo commands but do not execute)
+    -H    disable shallow (--depth 1) git clones; clone full history
+    -m D  keep persistent git repo mirrors in dir D (for shared team
+          caches). Default: <ssdroot>/.mirrors
     -X    set default build type to RelWithDebInfo
     -T    avoid setting up clang tools
     -J    run cmake steps serially (default is in parallel)
@@ -637,7 +1029,7 @@ def usage(msgarg):
 
       %s -r llvm-trunk -c
 
-    """ % (me, me, me, me, me)
+    """ % (me, me, me, me, me))
   sys.exit(1)
 
 
@@ -648,9 +1040,11 @@ def parse_args():
   global flag_do_fetch, flag_include_tools, flag_include_polly, flag_parallel
   global flag_binutils_build, flag_run_ninja, llvm_rw_svn, flag_user
   global ssdroot, flag_binutils_location, flag_btrfs, flag_include_libcxx
+  global flag_shallow, flag_mirror_root, flag_clone_from, flag_jobs
 
   try:
-    optlist, args = getopt.getopt(sys.argv[1:], "DPGJB:S:FTLMXqcdnNs:r:")
+    optlist, args = getopt.getopt(sys.argv[1:],
+                                  "DPGHJB:C:S:FTLMXm:qcdnNs:r:")
   except getopt.GetoptError as err:
     # unrecognized option
     usage(str(err))
@@ -664,6 +1058,8 @@ def parse_args():
       flag_run_ninja = False
     elif opt == "-c":
       flag_configure = True
+    elif opt == "-C":
+      flag_clone_from = arg
     elif opt == "-M":
       flag_configure = True
       flag_btrfs = False
@@ -683,6 +1079,10 @@ def parse_args():
       flag_dryrun = True
     elif opt == "-G":
       flag_include_llgo = True
+    elif opt == "-H":
+      flag_shallow = False
+    elif opt == "-m":
+      flag_mirror_root = arg
     elif opt == "-P":
       flag_include_polly = True
     elif opt == "-L":
@@ -708,15 +1108,17 @@ def parse_args():
     usage("specify subvol name with -r")
   if not flag_btrfs and flag_snapshot:
     usage("can't use -s with -M")
-  lines = u.docmdlines("whoami")
-  flag_user = lines[0]
+  if flag_clone_from and not flag_btrfs:
+    usage("can't use -C with -M (snapshots need btrfs)")
+  flag_jobs = default_job_count()
+  flag_user = pwd.getpwuid(os.geteuid()).pw_name
   if flag_user == "root":
     u.error("please don't run this script as root")
-  llvm_rw_svn = re.sub("REPLACE_WITH_USER", flag_user, llvm_rw_svn)
+  llvm_rw_svn = replaceuserrx.sub(flag_user, llvm_rw_svn)
   u.verbose(2, "llvm_rw_svn is: %s" % llvm_rw_svn)
 
   # Validate cmake_flavors
-  for tag, d in cmake_flavors.iteritems():
+  for tag, d in cmake_flavors.items():
     for subtag in d:
       if subtag not in legal_tags:
         u.error("internal error: cmake_flavors entry %s "
@@ -725,9 +1127,11 @@ def parse_args():
   # Set ssd root
   here = os.getcwd()
   if flag_btrfs:
-    ssdroot = u.determine_btrfs_ssdroot(here)
+    ssdroot = cached_btrfs_ssdroot(here)
   else:
     ssdroot = here
+  if not flag_mirror_root:
+    flag_mirror_root = "%s/.mirrors" % ssdroot
 
 
 #